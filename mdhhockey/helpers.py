@@ -77,7 +77,19 @@ AZURE_SCOPES = ["Files.ReadWrite.All", "Sites.ReadWrite.All", "User.Read"]
 AZURE_AUTHORITY = 'https://login.microsoftonline.com/consumers'
 AZURE_TOKEN_CACHE = f'{CACHE_DIR}/cache.bin'
 AZURE_USER = config['azure']['user']
-CAPFRIENDLY_GRAPH_URL_ROOT = "https://graph.microsoft.com/v1.0/drives/56555516577eabf8/items/56555516577EABF8!64168/workbook"
+CAPFRIENDLY_ITEM_URL = "https://graph.microsoft.com/v1.0/drives/56555516577eabf8/items/56555516577EABF8!64168"
+CAPFRIENDLY_GRAPH_URL_ROOT = f"{CAPFRIENDLY_ITEM_URL}/workbook"
+# The workbook's file content, through the /me/drive path that request_with_retries warms up auth with
+CAPFRIENDLY_CONTENT_URL = "https://graph.microsoft.com/v1.0/me/drive/items/56555516577EABF8!64168/content"
+
+# How the CF workbook gets published:
+#   "graph" - edit the live workbook in place through the Graph workbook API (many small calls)
+#   "file"  - download the workbook, fill it in locally, and upload it back in one upload session
+CAPFRIENDLY_PUBLISH_MODE = config.get('azure', 'publish_mode', fallback='graph')
+# Upload session chunks must be a multiple of 320 KiB
+CAPFRIENDLY_UPLOAD_CHUNK_SIZE = 320 * 1024 * 16
+# Seconds to wait on any single file-mode download/upload request before retrying it
+CAPFRIENDLY_UPLOAD_TIMEOUT = 60
 
 def _acquire_azure_token():
   cache = msal.SerializableTokenCache()
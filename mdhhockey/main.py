@@ -6,18 +6,27 @@
 # Location of this app: https://entra.microsoft.com/#view/Microsoft_AAD_RegisteredApps
 
 import csv
+import io
 import json
 import os
 import re
 import requests
+import time
+import zipfile
 from bs4 import BeautifulSoup
+from copy import copy
 from datetime import date, datetime
 from dateutil.relativedelta import relativedelta
+from openpyxl import load_workbook
+from openpyxl.formula.translate import Translator
+from openpyxl.utils import get_column_letter, range_boundaries
+from openpyxl.worksheet.cell_range import CellRange
 from zoneinfo import ZoneInfo
 
 from mdhhockey.helpers import (_replace_special_chars, _acquire_azure_token)
 from mdhhockey.helpers import (
-  _K, CACHE_DIR, CAPFRIENDLY_GRAPH_URL_ROOT, FANTRAX_EXPORT_FP, FANTRAX_LEAGUE_URL, FANTRAX_EXPORT_URL, FANTRAX_CAP_HITS_URL,
+  _K, CACHE_DIR, CAPFRIENDLY_CONTENT_URL, CAPFRIENDLY_GRAPH_URL_ROOT, CAPFRIENDLY_ITEM_URL, CAPFRIENDLY_PUBLISH_MODE,
+  CAPFRIENDLY_UPLOAD_CHUNK_SIZE, CAPFRIENDLY_UPLOAD_TIMEOUT, FANTRAX_EXPORT_FP, FANTRAX_LEAGUE_URL, FANTRAX_EXPORT_URL, FANTRAX_CAP_HITS_URL,
   FANTRAX_LOGIN_COOKIE, INPUTS_DIR, NHL_API_BASE_URL, NHL_API_SEARCH_URL, FANTRAX_TEAM_MAP, FANTRAX_DRAFT_PICKS_URL
 )
 
@@ -295,27 +304,37 @@ def unprotect_sheet(sheet, token):
 def protect_sheet(sheet, token):
   request_with_retries(f"{sheet}/protection/protect", {'Authorization': f'Bearer {token}'}, method="POST")
 
-def request_with_retries(url, headers, method="GET", json=None, num_retries=5):
+def request_with_retries(url, headers, method="GET", json=None, num_retries=5, warm_up=True, timeout=None):
   # I have no clue why, but hitting this endpoint before the one I want to hit fixes my auth issues. I think it's a security bug, but /shrug
-  resp = requests.get(f"https://graph.microsoft.com/v1.0/me/drive/items/56555516577EABF8!64168/content", headers=headers)
+  # It downloads the whole workbook though, so callers that have just hit it themselves can skip it with `warm_up=False`
+  if warm_up:
+    resp = requests.get(CAPFRIENDLY_CONTENT_URL, headers=headers, timeout=timeout)
 
   retries = 0
   while retries < num_retries:
-    if method == "GET":
-      resp = requests.get(url, headers=headers)
-    elif method == "POST":
-      resp = requests.post(url, headers=headers, json=json)
-    elif method == "PATCH":
-      resp = requests.patch(url, headers=headers, json=json)
-    else:
-      print(f"ERROR: Unsupported method {method} in request_with_retries")
-      quit()
-
     retries += 1
+    try:
+      if method == "GET":
+        resp = requests.get(url, headers=headers, timeout=timeout)
+      elif method == "POST":
+        resp = requests.post(url, headers=headers, json=json, timeout=timeout)
+      elif method == "PATCH":
+        resp = requests.patch(url, headers=headers, json=json, timeout=timeout)
+      else:
+        print(f"ERROR: Unsupported method {method} in request_with_retries")
+        quit()
+    except requests.RequestException as e:
+      print(f"ERROR: {e} from {url}")
+      resp = None
+      continue
 
     if resp.status_code < 300:
       break
 
+  if resp is None:
+    print(f"ERROR: No response from {url} after {num_retries} attempts. Aborting.")
+    quit()
+
   print(f"ERROR: {resp.status_code} from {url}" if resp.status_code >= 300 else resp.status_code)
   return resp
 
@@ -338,8 +357,231 @@ def delete_old_range(sheet, range, token):
   request_with_retries(f"{CAPFRIENDLY_GRAPH_URL_ROOT}/worksheets/{sheet}/range(address='{range}')/delete", {'Authorization': f'Bearer {token}'}, method="POST", json={'shift': 'Up'})
 
 #endregion
+#region local workbook functions
+
+def download_workbook(token):
+  print("Downloading workbook...")
+  # This is the same URL the warm-up hits, so doing the warm-up first would just download the workbook twice
+  resp = request_with_retries(
+    CAPFRIENDLY_CONTENT_URL, {'Authorization': f'Bearer {token}'}, warm_up=False, timeout=CAPFRIENDLY_UPLOAD_TIMEOUT
+  )
+  if resp.status_code >= 300:
+    print("ERROR: Failed to download the workbook. Aborting.")
+    quit()
 
-def update_bid_grid(token):
+  unsupported = find_unsupported_workbook_parts(resp.content)
+  if unsupported:
+    print(f"ERROR: Workbook has {', '.join(unsupported)}, which openpyxl would drop on upload. Use publish_mode = graph. Aborting.")
+    quit()
+
+  # rich_text keeps partially formatted cells from being flattened to plain strings
+  return load_workbook(io.BytesIO(resp.content), rich_text=True)
+
+def find_unsupported_workbook_parts(content):
+  """
+    List the parts of the xlsx package that openpyxl can't round-trip (charts,
+    images/drawings, slicers/timelines and worksheet extensions such as x14
+    conditional formatting, data validation and sparklines), so we never upload a
+    workbook that silently lost them. Comments are fine, even though Excel stores
+    them with a legacy VML drawing.
+  """
+  found = set()
+  with zipfile.ZipFile(io.BytesIO(content)) as package:
+    for name in package.namelist():
+      if name.startswith(("xl/charts/", "xl/chartsheets/")):
+        found.add("charts")
+      elif name.startswith(("xl/slicers/", "xl/slicerCaches/", "xl/timelines/", "xl/timelineCaches/")):
+        found.add("slicers/timelines")
+      elif name.startswith("xl/drawings/") and name.endswith(".vml"):
+        # Comment boxes are all ObjectType="Note", anything else is a shape or control
+        object_types = re.findall(rb'ObjectType="(\w+)"', package.read(name))
+        if not object_types or any(t != b"Note" for t in object_types):
+          found.add("drawings/images")
+      elif name.startswith(("xl/drawings/", "xl/media/")) and "/_rels/" not in name:
+        found.add("drawings/images")
+      elif re.fullmatch(r"xl/worksheets/[^/]+\.xml", name):
+        # openpyxl drops a worksheet's whole extLst
+        if re.search(rb"<(\w+:)?extLst[\s>]", package.read(name)):
+          found.add("worksheet extensions (x14 conditional formatting, data validation, sparklines, ...)")
+  return sorted(found)
+
+def upload_workbook(workbook, token):
+  """
+    Upload the finished workbook over the existing one through a resumable upload
+    session. If a chunk fails, ask the session which bytes it still expects and
+    pick up from there.
+  """
+  output = io.BytesIO()
+  workbook.save(output)
+  content = output.getvalue()
+
+  print("Uploading workbook...")
+  # download_workbook just hit the warm-up URL, so skip pulling the whole workbook again here
+  resp = request_with_retries(
+    f"{CAPFRIENDLY_ITEM_URL}/createUploadSession", {'Authorization': f'Bearer {token}'}, method="POST",
+    json={'item': {'@microsoft.graph.conflictBehavior': 'replace'}}, warm_up=False, timeout=CAPFRIENDLY_UPLOAD_TIMEOUT
+  )
+  if resp.status_code >= 300:
+    print("ERROR: Failed to create an upload session. Aborting.")
+    quit()
+
+  # The upload URL is pre-authenticated, so it must not be sent the Authorization header
+  upload_url = resp.json()['uploadUrl']
+  total = len(content)
+  offset = 0
+  retries = 0  # per chunk, reset after each successful one
+  while offset < total:
+    chunk = content[offset:offset + CAPFRIENDLY_UPLOAD_CHUNK_SIZE]
+    headers = {
+      'Content-Length': str(len(chunk)),
+      'Content-Range': f'bytes {offset}-{offset + len(chunk) - 1}/{total}'
+    }
+    try:
+      resp = requests.put(upload_url, headers=headers, data=chunk, timeout=CAPFRIENDLY_UPLOAD_TIMEOUT)
+      error = None if resp.status_code < 300 else resp.status_code
+    except requests.RequestException as e:
+      error = e
+
+    if error is None:
+      offset += len(chunk)
+      retries = 0
+      continue
+
+    retries += 1
+    if retries >= 5:
+      print(f"ERROR: {error} uploading the workbook. Aborting.")
+      try:
+        requests.delete(upload_url, timeout=CAPFRIENDLY_UPLOAD_TIMEOUT)
+      except requests.RequestException:
+        pass
+      quit()
+
+    time.sleep(2 ** retries)
+
+    # Resume from wherever the session says it's missing data
+    try:
+      status = requests.get(upload_url, timeout=CAPFRIENDLY_UPLOAD_TIMEOUT)
+      if status.status_code < 300 and status.json().get('nextExpectedRanges'):
+        offset = int(status.json()['nextExpectedRanges'][0].split('-')[0])
+    except requests.RequestException:
+      pass  # Just retry the same chunk
+
+  print(resp.status_code)
+
+def to_excel_value(value):
+  """
+    Convert a value the way Excel would interpret it if it were typed into a cell,
+    which is what the Graph range/table APIs do with the values we send them.
+  """
+  if not isinstance(value, str):
+    return value
+  if value == "":
+    return None
+  if value.startswith("'"):
+    return value[1:]  # Escaped for Excel formatting, keep as text
+  if re.fullmatch(r'-?\d+', value):
+    return int(value)
+  if re.fullmatch(r'-?\d*\.\d+', value):
+    return float(value)
+  if re.fullmatch(r'\d{4}-\d{2}-\d{2}', value):
+    return date.fromisoformat(value)
+  return value
+
+def find_ranges_blocking_shift(sheet, table, min_col, max_col, shift_start, last_row):
+  """
+    openpyxl only moves cells, not the ranges that point at them. List any other
+    table, merge, conditional format or data validation in the table's columns that
+    reaches into the rows being shifted, unless it already covers every row the
+    table's columns will use (first data row through `last_row`).
+  """
+  first_row = range_boundaries(table.ref)[1] + 1
+  ranges = [(f"table {t.name}", CellRange(t.ref)) for t in sheet.tables.values() if t.name != table.name]
+  ranges += [("merged cells", r) for r in sheet.merged_cells.ranges]
+  ranges += [("conditional formatting", r) for cf in sheet.conditional_formatting for r in cf.sqref.ranges]
+  ranges += [("data validation", r) for dv in sheet.data_validations.dataValidation for r in dv.sqref.ranges]
+
+  blocking = []
+  for kind, r in ranges:
+    if r.max_col < min_col or r.min_col > max_col or r.max_row < shift_start:
+      continue
+    if r.min_row <= first_row and r.max_row >= last_row:
+      continue
+    blocking.append(f"{kind} {r.coord}")
+  return blocking
+
+def fill_table(sheet, table_name, data):
+  """
+    Replace the data rows of `table_name` with `data`, matching the formatting
+    (and any calculated columns) of the table's existing first row. Like the Graph
+    rows/delete calls, only the table's own columns are shifted to resize it, so
+    content below it (including a totals row) moves with it instead of being
+    overwritten, and anything beside it stays put.
+  """
+  print(f'Filling {table_name} table...')
+  table = sheet.tables[table_name]
+  min_col, min_row, max_col, max_row = range_boundaries(table.ref)
+  first_row = min_row + 1  # skip the header row
+  totals_rows = table.totalsRowCount or 0
+  old_count = max_row - totals_rows - min_row
+  new_count = max(len(data), 1)  # a table always keeps at least one data row
+  shift = new_count - old_count
+  shift_start = first_row + min(old_count, new_count)
+  below_row = first_row + old_count  # first row after the old data rows
+  # Last row holding anything in the table's columns, since only those get shifted
+  columns_max_row = max((r for (r, c) in sheet._cells if min_col <= c <= max_col), default=max_row)
+
+  if shift:
+    blocking = find_ranges_blocking_shift(
+      sheet, table, min_col, max_col, shift_start, max(columns_max_row, max_row) + max(shift, 0)
+    )
+    if blocking:
+      print(f"ERROR: Resizing {table_name} would leave behind {', '.join(blocking)}. Use publish_mode = graph. Aborting.")
+      quit()
+
+  template = [sheet.cell(first_row, col) for col in range(min_col, max_col + 1)]
+  template_styles = [copy(cell._style) for cell in template]
+  template_formulas = [
+    cell.value if isinstance(cell.value, str) and cell.value.startswith("=") else None
+    for cell in template
+  ]
+  template_coords = [cell.coordinate for cell in template]
+
+  if shift < 0:
+    # Drop the leftover rows' cells entirely, like a range delete
+    for r in range(shift_start, below_row):
+      for col in range(min_col, max_col + 1):
+        sheet._cells.pop((r, col), None)
+  if shift and columns_max_row >= below_row:
+    sheet.move_range(
+      f"{get_column_letter(min_col)}{below_row}:{get_column_letter(max_col)}{columns_max_row}", rows=shift
+    )
+
+  for i in range(new_count):
+    row = data[i] if i < len(data) else []
+    for j, col in enumerate(range(min_col, max_col + 1)):
+      cell = sheet.cell(first_row + i, col)
+      cell._style = copy(template_styles[j])
+      if j < len(row):
+        cell.value = to_excel_value(row[j])
+      elif template_formulas[j] and row:
+        cell.value = Translator(template_formulas[j], template_coords[j]).translate_formula(cell.coordinate)
+      else:
+        cell.value = None
+
+  new_max_row = first_row + new_count - 1 + totals_rows
+  table.ref = f"{get_column_letter(min_col)}{min_row}:{get_column_letter(max_col)}{new_max_row}"
+  if table.autoFilter:
+    table.autoFilter.ref = f"{get_column_letter(min_col)}{min_row}:{get_column_letter(max_col)}{new_max_row - totals_rows}"
+
+def fill_range(sheet, top_left, values):
+  min_col, min_row, _, _ = range_boundaries(top_left)
+  for i, row in enumerate(values):
+    for j, value in enumerate(row):
+      sheet.cell(min_row + i, min_col + j).value = to_excel_value(value)
+
+#endregion
+
+def get_bid_grid_data():
   headers = { 'Cookie': FANTRAX_LOGIN_COOKIE}
 
   base_year = curr_year
@@ -434,6 +676,11 @@ def update_bid_grid(token):
 
     rows.append(row)
 
+  return rows
+
+def update_bid_grid(token):
+  rows = get_bid_grid_data()
+
   BID_GRID_SHEET = f'{CAPFRIENDLY_GRAPH_URL_ROOT}/worksheets/Bid Grid'
 
   print("Updating Bid Grid...")
@@ -441,17 +688,10 @@ def update_bid_grid(token):
   request_with_retries(f"{BID_GRID_SHEET}/range(address='A4:H21')", {'Authorization': f'Bearer {token}'}, method="PATCH", json={'values': rows})
   protect_sheet(BID_GRID_SHEET, token)
 
-def generate_data_for_capfriendly():
-  contract_data = get_contract_data()
-  caphit_data = get_caphit_data()
-
-  result = _acquire_azure_token()
-  if "access_token" not in result:
-    print("ERROR: Unable to get Azure access_token. Aboritng.")
-    quit()
-
-  token = result["access_token"]
+def get_timestamp():
+  return datetime.now(ZoneInfo("America/New_York")).strftime("%Y/%m/%d %H:%M") + " EST"
 
+def publish_with_graph(contract_data, caphit_data, token):
   CONTRACTS_SHEET = f'{CAPFRIENDLY_GRAPH_URL_ROOT}/worksheets/All Contracts'
   CONTRACTS_TABLE = f'{CONTRACTS_SHEET}/tables/Players'
   HITS_SHEET = f'{CAPFRIENDLY_GRAPH_URL_ROOT}/worksheets/All Penalties'
@@ -476,11 +716,35 @@ def generate_data_for_capfriendly():
   # Update the last updated timestamp
   print("Updating last updated timestamp...")
   unprotect_sheet(SUMMARY_SHEET, token)
-  timestamp = datetime.now(ZoneInfo("America/New_York")).strftime("%Y/%m/%d %H:%M") + " EST"
-  request_with_retries(f"{SUMMARY_SHEET}/range(address='A25')", {'Authorization': f'Bearer {token}'}, method="PATCH", json={'values': [[timestamp]]})
+  request_with_retries(f"{SUMMARY_SHEET}/range(address='A25')", {'Authorization': f'Bearer {token}'}, method="PATCH", json={'values': [[get_timestamp()]]})
   protect_sheet(SUMMARY_SHEET, token)
 
-  # check for violations
+def publish_with_file(contract_data, caphit_data, token):
+  """
+    Build the whole update locally and upload it as a single file, so the live
+    workbook goes straight from the old data to the new. Sheet protection is kept
+    as-is, since writing cells locally doesn't need the sheets unprotected.
+
+    openpyxl doesn't keep cached formula results, so the uploaded file only has
+    values once Excel (desktop or online) recalculates it. Viewers that don't
+    recalculate will show blank formula cells.
+  """
+  workbook = download_workbook(token)
+
+  fill_table(workbook["All Contracts"], "Players", contract_data)
+  fill_table(workbook["All Penalties"], "Hits", caphit_data)
+
+  print("Updating Bid Grid...")
+  fill_range(workbook["Bid Grid"], "A4", get_bid_grid_data())
+
+  print("Updating last updated timestamp...")
+  fill_range(workbook["Summary"], "A25", [[get_timestamp()]])
+
+  upload_workbook(workbook, token)
+
+def check_for_violations(token):
+  SUMMARY_SHEET = f'{CAPFRIENDLY_GRAPH_URL_ROOT}/worksheets/Summary'
+
   if is_offseason:
     print("Skipping violation checks for offseason")
   else:
@@ -498,5 +762,26 @@ def generate_data_for_capfriendly():
       if data[n][11] > data[2][15]:
         print(f"ERROR: Cap Ceiling Violation Found for team {data[n][1]}")
 
+def generate_data_for_capfriendly():
+  contract_data = get_contract_data()
+  caphit_data = get_caphit_data()
+
+  result = _acquire_azure_token()
+  if "access_token" not in result:
+    print("ERROR: Unable to get Azure access_token. Aboritng.")
+    quit()
+
+  token = result["access_token"]
+
+  if CAPFRIENDLY_PUBLISH_MODE == "file":
+    publish_with_file(contract_data, caphit_data, token)
+  elif CAPFRIENDLY_PUBLISH_MODE == "graph":
+    publish_with_graph(contract_data, caphit_data, token)
+  else:
+    print(f"ERROR: Unsupported publish_mode {CAPFRIENDLY_PUBLISH_MODE}. Aborting.")
+    quit()
+
+  check_for_violations(token)
+
 if __name__ == '__main__':
   generate_data_for_capfriendly()